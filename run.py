@@ -1,13 +1,33 @@
 import argparse
-import pandas as pd
-from vllm import LLM, SamplingParams
+import asyncio
+import re
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from tqdm.asyncio import tqdm_asyncio
+from vllm import SamplingParams
+from vllm.engine.arg_utils import AsyncEngineArgs
+from vllm.engine.async_llm_engine import AsyncLLMEngine
 
+# matches the float on the 'Estimated Probability: X' answer line
+_PROBABILITY_RE = re.compile(r"Estimated Probability:\s*([0-9]*\.?[0-9]+)")
+
+# number of finished results to buffer before flushing a parquet row group
+_WRITE_BATCH_SIZE = 256
+
+_RESULT_SCHEMA = pa.schema([
+    ('drug', pa.string()),
+    ('prob', pa.float32()),
+    ('response', pa.string()),
+])
+
+
+# every token in this shared prefix is prefilled (or cached) for all
+# ~16k requests, so keep it at the minimum unambiguous instruction
 SYSTEM_PROMPT = (
-    "You are a medical language model designed to estimate the probability that a patient has "
-    "Type II diabetes based on a specific medicine. Your goal is to provide the probability as a clear float. "
-    "Please keep your reasoning concise and avoid unnecessary explanations. Always output your final answer "
-    "as a float number on a new line starting with 'Estimated Probability:'."
+    "Estimate P(Type II diabetes | drug). Output last line: "
+    "'Estimated Probability: X' where X is a float in [0,1]."
 )
 
 
@@ -20,107 +40,260 @@ def create_conversation(drug, cot):
         },
         {
             "role": "user",
+            # keep the variable drug name at the very end of the message so
+            # that the shared instruction boilerplate forms the longest
+            # possible cacheable prefix (prefix caching works at KV-block
+            # granularity)
             "content": (
-                f"Given that a patient took {drug}, estimate the probability that they have Type II diabetes. "
-                "You may think aloud and reason step-by-step."
-                "You should provide the final answer on a new line in the format: "
-                "'Estimated Probability: X', where X is the probability."
+                "Reason step-by-step, then end with the answer line. "
+                f"Drug: {drug}"
             ) if cot else
-            (
-                f"Given that a patient took {drug}, estimate the probability that they have Type II diabetes. "
-                "You should provide the final answer on a new line in the format: "
-                "'Estimated Probability: X', where X is the probability."
-            )
+            f"Drug: {drug}"
         }
     ]
 
 
-def estimate_diabetes_probability(drugs: list, cot: bool, batch_size: int = 1) -> list:
+def build_sampling_params(args, cot):
+    # hyperparams refer to https://github.com/meta-llama/llama3/blob/main/llama/generation.py
+    # a tight max_tokens shrinks the worst-case KV reservation per sequence,
+    # so the scheduler can admit more concurrent requests; non-CoT answers
+    # are a single short line, CoT rarely exceeds a few hundred tokens
+    max_tokens = 512 if cot else 32
+    # non-CoT answers are a single line, so the first newline ends them;
+    # CoT reasoning routinely contains blank lines between steps, so no
+    # stop string there -- the 512-token cap and EOS bound it instead
+    stop = None if cot else ["\n"]
+    # this is point-estimate extraction, not creative writing: greedy decode
+    # skips the top-p sort and RNG per token and makes runs reproducible.
+    # Monte Carlo estimates (--n_samples > 1) need sampling, and n=k in
+    # SamplingParams shares one prompt prefill across the k completions
+    # instead of issuing k separate requests
+    temperature = (0.0 if args.greedy and args.n_samples == 1
+                   else args.temperature)
+    return SamplingParams(temperature=temperature, top_p=0.9,
+                          n=args.n_samples,
+                          max_tokens=max_tokens,
+                          stop=stop,
+                          skip_special_tokens=True)
+
+
+def parse_probability(response_text):
+    # extract the float from the 'Estimated Probability' line;
+    # unparseable responses come out as NaN
+    match = _PROBABILITY_RE.search(response_text)
+    return float(match.group(1)) if match else float("nan")
+
+
+async def _generate_one(llm, sampling_params, prompt_token_ids, request_id):
+    # drain the stream for this request and parse as soon as it finishes,
+    # so CPU-side parsing hides under the GPU decode of other requests
+    final_output = None
+    async for output in llm.generate({"prompt_token_ids": prompt_token_ids},
+                                     sampling_params,
+                                     request_id=request_id):
+        final_output = output
+    # with n > 1 the request carries several completions that shared one
+    # prefill; average their parsed probabilities, ignoring failures
+    probas = [parse_probability(o.text) for o in final_output.outputs]
+    proba = float(np.nanmean(probas)) if not all(np.isnan(probas)) else float("nan")
+    response_text = "\n\n---\n\n".join(o.text for o in final_output.outputs)
+    return int(request_id), proba, response_text
+
+
+async def estimate_diabetes_probability(llm, sampling_params, drugs: list,
+                                        cot: bool, save_path: str) -> list:
     """
     Estimate the probability that a patient has Type II diabetes given that they took
     the specified medicines. Use chain-of-thought reasoning and provide the final result
     in a clear float format.
 
+    Results are streamed to `save_path` as they complete (one row per drug:
+    name, probability, raw response), so a crash mid-run keeps everything
+    finished so far instead of losing the whole batch.
+
     Args:
+        llm: The AsyncLLMEngine instance to generate with; sharing one
+            instance across calls amortizes model load and keeps the
+            prefix cache warm.
+        sampling_params: SamplingParams for this run.
         drugs: List of the names of the medicines the patient took.
         cot: Boolean indicating if chain-of-thought reasoning should be used.
-        batch_size: The number of drugs to process in each batch.
+        save_path: Parquet file the results are written to incrementally.
 
     Returns:
-        - probas: A list of estimated probabilities between 0 and 1.
-        - responses: The raw text responses generated by the model for further analysis.
+        - probas: A list of estimated probabilities between 0 and 1,
+          in the same order as `drugs`.
     """
-    estimated_probabilities = []
-    response_texts = []
-
-    for i in range(0, len(drugs), batch_size):
-        batch_drugs = drugs[i:i + batch_size]
-        conversations = [create_conversation(drug, cot) for drug in batch_drugs]
-
-        outputs = llm.chat(
-            messages=conversations,
-            sampling_params=sampling_params,
-            use_tqdm=True
-        )
-
-        # process in batch
-        for output in outputs:
-            response_text = output.outputs[0].text
-            response_texts.append(response_text)
-            # extract the probability from the model output using the 'Estimated Probability' marker
-            lines = response_text.split("\n")
-            probability_line = [line for line in lines if
-                                "Estimated Probability" in line]
-
-            if probability_line:
-                try:
-                    # parse the float from the 'Estimated Probability' line
-                    estimated_probability = float(
-                        probability_line[0].split(":")[1].strip())
-                except (IndexError, ValueError):
-                    # handle parsing errors
-                    estimated_probability = None
-            else:
-                estimated_probability = None
-
-            estimated_probabilities.append(estimated_probability)
-
-    return estimated_probabilities, response_texts
+    # the async engine takes rendered prompts, not chat messages, so apply
+    # the chat template ourselves -- once, with a placeholder for the drug
+    # name, rather than re-running the jinja template 15,980 times
+    tokenizer = await llm.get_tokenizer()
+    prompt_template = tokenizer.apply_chat_template(
+        create_conversation("__DRUG__", cot),
+        tokenize=False,
+        add_generation_prompt=True)
+    prompts = [prompt_template.replace("__DRUG__", drug) for drug in drugs]
+
+    # tokenize all prompts in one batched call -- the Rust fast tokenizer
+    # parallelizes internally and releases the GIL -- and hand the engine
+    # token ids directly, skipping per-request tokenization on the hot
+    # path (the rendered template already contains the BOS token, hence
+    # add_special_tokens=False)
+    encodings = tokenizer(prompts, add_special_tokens=False,
+                          return_attention_mask=False)["input_ids"]
+
+    # submit every request at once; vLLM's continuous-batching scheduler
+    # keeps up to max_num_seqs sequences in flight, and each coroutine
+    # parses its response the moment it completes instead of waiting for
+    # the whole batch to drain. Submitting in ascending token-length order
+    # groups similar-length prefills into the same scheduler iterations,
+    # so short prompts don't ride along with long ones
+    order = np.argsort([len(token_ids) for token_ids in encodings])
+    tasks = [_generate_one(llm, sampling_params, encodings[idx],
+                           request_id=str(idx))
+             for idx in order]
+
+    # stream finished rows into the parquet file in completion order,
+    # one row group per _WRITE_BATCH_SIZE results, instead of holding
+    # every raw response in RAM until the end of the run
+    estimated_probabilities = [float("nan")] * len(drugs)
+    buffer = []
+    with pq.ParquetWriter(save_path, _RESULT_SCHEMA,
+                          compression='zstd') as writer:
+        for n_done, future in enumerate(tqdm_asyncio.as_completed(tasks)):
+            idx, proba, text = await future
+            # fail fast on the first result if parsing is broken (e.g. a
+            # vLLM output-object change), rather than burning GPU hours
+            # writing a parquet full of NaNs
+            if n_done == 0 and not 0.0 <= proba <= 1.0:
+                raise ValueError(
+                    "first completed response did not parse to a "
+                    f"probability in [0,1]: {text[:200]!r}")
+            estimated_probabilities[idx] = proba
+            buffer.append((drugs[idx], proba, text))
+            if len(buffer) >= _WRITE_BATCH_SIZE:
+                writer.write_batch(pa.RecordBatch.from_pydict(
+                    dict(zip(_RESULT_SCHEMA.names, zip(*buffer))),
+                    schema=_RESULT_SCHEMA))
+                buffer.clear()
+        if buffer:
+            writer.write_batch(pa.RecordBatch.from_pydict(
+                dict(zip(_RESULT_SCHEMA.names, zip(*buffer))),
+                schema=_RESULT_SCHEMA))
+
+    return estimated_probabilities
+
+
+async def main(args):
+    # the async engine streams each request's output back as it finishes,
+    # so parsing overlaps with the GPU instead of running after the batch
+    engine_args = AsyncEngineArgs(
+        model=args.model,
+        tensor_parallel_size=args.num_gpus,
+        # every request shares the same system prompt + instruction
+        # boilerplate, so its KV cache is computed once and reused
+        enable_prefix_caching=True,
+        # prompts are short and decode dominates, so pack as many
+        # sequences as the KV pool allows
+        max_num_seqs=args.max_num_seqs,
+        gpu_memory_utilization=args.gpu_memory_utilization,
+        # chunked prefill splits prefills into pieces that co-run with
+        # decodes in every iteration, so a wave of new prompts never
+        # stalls sequences that are mid-generation
+        enable_chunked_prefill=True,
+        max_num_batched_tokens=args.max_num_batched_tokens,
+        # ~40 prompt tokens + the 512-token CoT generation cap + slack;
+        # a tight max_model_len lets the KV profiler fit more sequences
+        max_model_len=1024,
+        # FP8 weights (auto-detected from the checkpoint) halve the
+        # model's VRAM footprint, and an FP8 KV cache doubles how many
+        # sequences fit in the remaining blocks; decode is
+        # bandwidth-bound, so both translate into throughput
+        dtype="auto",
+        kv_cache_dtype=args.kv_cache_dtype,
+        # the output format is mostly fixed tokens ('Estimated
+        # Probability: 0.'), so prompt-lookup (n-gram) speculation
+        # drafts several tokens per target forward pass for free --
+        # no draft model needed
+        speculative_config={
+            "method": "ngram",
+            "num_speculative_tokens": 5,
+            "prompt_lookup_max": 4,
+        },
+    )
+    llm = AsyncLLMEngine.from_engine_args(engine_args)
+
+    # read just the one column we need, straight through pyarrow
+    table = pq.read_table('drugs_15980.parquet',
+                          columns=['standard_concept_name'])
+    drugs = table.column('standard_concept_name').to_pylist()
+
+    # run inference once per unique drug name and broadcast the results back
+    # to the full list; duplicates are free requests otherwise
+    unique_drugs, inverse = np.unique(np.asarray(drugs), return_inverse=True)
+    print(f"{len(unique_drugs)} unique drugs out of {len(drugs)}")
+
+    # one engine instance serves both modes, so the model load is paid
+    # once and the shared system-prompt prefix cache stays warm between
+    # the non-CoT and CoT passes
+    for cot in (False, True):
+        sampling_params = build_sampling_params(args, cot)
+        suffix = "_cot" if cot else ""
+        stream_path = f"drug_t2d_unique_probas{suffix}.parquet"
+        save_path = f"drug_t2d_15980_probas{suffix}.parquet"
+        probas_unique = await estimate_diabetes_probability(
+            llm, sampling_params, unique_drugs.tolist(), cot=cot,
+            save_path=stream_path)
+
+        # the streamed checkpoint holds one row per unique drug in
+        # completion order; broadcast back to the full source order and
+        # (prob, response) schema that downstream consumers of the
+        # drug_t2d_15980_probas files expect, realigning the checkpoint's
+        # responses by drug name
+        unique_table = pq.read_table(stream_path)
+        response_by_drug = dict(zip(
+            unique_table.column('drug').to_pylist(),
+            unique_table.column('response').to_pylist()))
+        responses_unique = [response_by_drug[drug]
+                            for drug in unique_drugs.tolist()]
+        probas = np.asarray(probas_unique, dtype=np.float32)[inverse]
+        responses = np.asarray(responses_unique, dtype=object)[inverse]
+        result_table = pa.table({
+            'prob': pa.array(probas.tolist(), type=pa.float32()),
+            'response': pa.array(responses.tolist(), type=pa.string()),
+        })
+        pq.write_table(result_table, save_path, compression='zstd')
+
+        n_parsed = int(np.count_nonzero(~np.isnan(probas)))
+        print(f"parsed {n_parsed}/{len(probas)} probabilities -> {save_path}")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(
         description="Run diabetes probability estimation with options.")
     parser.add_argument('--model', type=str,
-                        default="meta-llama/Meta-Llama-3-8B-Instruct",
+                        default="neuralmagic/Meta-Llama-3-8B-Instruct-FP8",
                         help='Huggingface model name to use.')
-    parser.add_argument('--cot', action='store_true',
-                        help='Enable chain-of-thought reasoning.')
+    parser.add_argument('--kv_cache_dtype', type=str, default="fp8_e4m3",
+                        help='KV cache dtype; pass "auto" to match the model dtype.')
     parser.add_argument('--num_gpus', type=int, default=1,
                         help='Number of GPUs to use.')
+    parser.add_argument('--greedy', action=argparse.BooleanOptionalAction,
+                        default=True,
+                        help='Use greedy decoding (deterministic); pass --no-greedy to sample.')
     parser.add_argument('--temperature', type=float, default=0.6,
-                        help='Temperature parameter for sampling.')
-    parser.add_argument('--batch_size', type=int, default=4,
-                        help='Batch size for estimation.')
-
+                        help='Temperature parameter for sampling (ignored when greedy).')
+    parser.add_argument('--n_samples', type=int, default=1,
+                        help='Completions sampled per drug and averaged; >1 implies sampling.')
+    parser.add_argument('--max_num_seqs', type=int, default=512,
+                        help='Maximum number of sequences vLLM keeps in flight.')
+    parser.add_argument('--gpu_memory_utilization', type=float, default=0.92,
+                        help='Fraction of GPU memory vLLM may reserve.')
+    parser.add_argument('--max_num_batched_tokens', type=int, default=2048,
+                        help='Token budget per scheduler iteration.')
     args = parser.parse_args()
-    # hyperparams refer to https://github.com/meta-llama/llama3/blob/main/llama/generation.py
-    sampling_params = SamplingParams(temperature=args.temperature, top_p=0.9,
-                                     max_tokens=1024 * 4)
-
-    llm = LLM(model=args.model,
-              tensor_parallel_size=args.num_gpus,
-              # dtype='bf16'
-              )
-
-    df = pd.read_parquet('drugs_15980.parquet', engine='pyarrow')
-    drugs = df['standard_concept_name'].tolist()
-
-    probas, responses = estimate_diabetes_probability(drugs, cot=args.cot,
-                                                      batch_size=args.batch_size)
-    result_df = pd.DataFrame({
-        'prob': probas,
-        'response': responses
-    })
-    save_path = "drug_t2d_15980_probas.parquet" if not args.cot else "drug_t2d_15980_probas_cot.parquet"
-    result_df.to_parquet(save_path, engine='pyarrow')
+
+    # a single asyncio.run keeps the engine on one event loop for both
+    # passes; the engine's background tasks are bound to the loop they
+    # start on and do not survive it being closed
+    asyncio.run(main(args))